@@ -0,0 +1,341 @@
+import functools
+import json
+import logging
+import random
+import threading
+from bisect import bisect_left
+from contextvars import ContextVar
+from time import perf_counter
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+from django.http import HttpResponse, HttpResponseForbidden, HttpResponseNotFound
+from django.utils.crypto import constant_time_compare
+from rest_framework.fields import empty
+from rest_framework_simplejwt.authentication import JWTAuthentication
+
+
+# OVERVIEW
+# Per request instrumentation (enabled with INSTRUMENTATION_ENABLED in settings.py).
+# - InstrumentationMiddleware counts the SQL queries of every request and sums their time (connection.execute_wrapper),
+#   times the auth, view, signal handler and serializer phases, adds a Server-Timing header to the response and
+#   writes slow request / slow query log lines (JSON, thresholds and sampling in settings.py).
+#   the body of a streaming response (exports) is instrumented while it is iterated and the request is recorded when
+#   the stream closes; those responses have no Server-Timing header.
+# - every request is aggregated into in-memory per endpoint histograms, exposed in Prometheus text format by
+#   metrics_view (GET /metrics/). the histograms are per process, Prometheus sums them across workers.
+# - phases are timed with the `timed` decorator (TimedJWTAuthentication, TimedSerializerMixin, the vendor signal
+#   receivers). outside of an instrumented request it costs a single context variable lookup.
+# auth, signals, serializer and db are parts of the view time and may overlap (a query run by a signal handler is
+# counted both in signals and in db).
+
+
+logger = logging.getLogger(__name__)
+
+_current = ContextVar('request_profile', default=None)
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class RequestProfile:
+    """
+    timings of the request being served
+    """
+    __slots__ = ('queries', 'db_time', 'phases', 'running', 'view_start', 'endpoint')
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.phases = {}
+        self.running = set()
+        self.view_start = None
+        self.endpoint = None
+
+    def run(self, func, *args):
+        """
+        call func with this profile as the current request, counting its queries
+        """
+        token = _current.set(self)
+        try:
+            with connection.execute_wrapper(self.execute):
+                return func(*args)
+        finally:
+            _current.reset(token)
+
+    def execute(self, execute, sql, params, many, context):
+        """
+        connection.execute_wrapper hook: count the query and add its time to the request
+        """
+        start = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = perf_counter() - start
+            self.queries += 1
+            self.db_time += duration
+            if duration * 1000 >= settings.INSTRUMENTATION_SLOW_QUERY_MS and sampled():
+                log_event('slow_query', endpoint=self.endpoint, duration_ms=round(duration * 1000, 3), many=many, sql=sql[:2000])
+
+
+def timed(phase):
+    """
+    decorator adding the time spent in the function to a phase of the current request.
+    nested calls of the same phase (e.g. nested serializers) are only counted once
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            profile = _current.get()
+            if profile is None or phase in profile.running:
+                return func(*args, **kwargs)
+            profile.running.add(phase)
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profile.phases[phase] = profile.phases.get(phase, 0.0) + perf_counter() - start
+                profile.running.discard(phase)
+        return wrapper
+    return decorator
+
+
+class TimedJWTAuthentication(JWTAuthentication):
+    """
+    JWT authentication timed as the `auth` phase
+    """
+
+    @timed('auth')
+    def authenticate(self, request):
+        return super().authenticate(request)
+
+
+class TimedSerializerMixin:
+    """
+    serializer mixin timing serialization and validation as the `serializer` phase
+    """
+
+    @timed('serializer')
+    def to_representation(self, instance):
+        return super().to_representation(instance)
+
+    @timed('serializer')
+    def run_validation(self, data=empty):
+        return super().run_validation(data)
+
+
+def sampled():
+    rate = settings.INSTRUMENTATION_LOG_SAMPLE_RATE
+    return rate >= 1 or random.random() < rate
+
+
+def log_event(event, **fields):
+    """
+    write one structured (JSON) log line
+    """
+    logger.warning(json.dumps({'event': event, **fields}, default=str))
+
+
+#---------------------------------------------------------------------------------------------------------------------------#
+
+
+class EndpointHistograms:
+    """
+    in-memory request duration and query count histograms per endpoint (method + route)
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.endpoints = {}
+
+    def observe(self, method, route, status_code, duration, queries, phases):
+        with self.lock:
+            stats = self.endpoints.get((method, route))
+            if stats is None:
+                stats = self.endpoints[(method, route)] = {
+                    'duration': [0] * (len(DURATION_BUCKETS) + 1),
+                    'duration_sum': 0.0,
+                    'queries': [0] * (len(QUERY_BUCKETS) + 1),
+                    'queries_sum': 0,
+                    'phases': {},
+                    'status': {},
+                }
+            stats['duration'][bisect_left(DURATION_BUCKETS, duration)] += 1
+            stats['duration_sum'] += duration
+            stats['queries'][bisect_left(QUERY_BUCKETS, queries)] += 1
+            stats['queries_sum'] += queries
+            for phase, seconds in phases.items():
+                stats['phases'][phase] = stats['phases'].get(phase, 0.0) + seconds
+            stats['status'][status_code] = stats['status'].get(status_code, 0) + 1
+
+    def render(self):
+        """
+        Prometheus text exposition format
+        rtype: str
+        """
+        with self.lock:
+            endpoints = sorted(self.endpoints.items())
+            lines = []
+            for name, help_text, key, buckets in (
+                ('http_request_duration_seconds', 'Request duration in seconds.', 'duration', DURATION_BUCKETS),
+                ('http_request_queries', 'SQL queries per request.', 'queries', QUERY_BUCKETS),
+            ):
+                lines += [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+                for (method, route), stats in endpoints:
+                    labels = f'method="{_escape(method)}",route="{_escape(route)}"'
+                    cumulative = 0
+                    for bound, count in zip((*buckets, '+Inf'), stats[key]):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                    lines.append(f'{name}_sum{{{labels}}} {stats[key + "_sum"]}')
+                    lines.append(f'{name}_count{{{labels}}} {cumulative}')
+
+            lines += ['# HELP http_request_phase_seconds_total Time spent per request phase.', '# TYPE http_request_phase_seconds_total counter']
+            for (method, route), stats in endpoints:
+                for phase, seconds in sorted(stats['phases'].items()):
+                    lines.append(f'http_request_phase_seconds_total{{method="{_escape(method)}",route="{_escape(route)}",phase="{phase}"}} {seconds}')
+
+            lines += ['# HELP http_requests_total Requests by response status.', '# TYPE http_requests_total counter']
+            for (method, route), stats in endpoints:
+                for status_code, count in sorted(stats['status'].items()):
+                    lines.append(f'http_requests_total{{method="{_escape(method)}",route="{_escape(route)}",status="{status_code}"}} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+histograms = EndpointHistograms()
+
+
+#---------------------------------------------------------------------------------------------------------------------------#
+
+
+class InstrumentedStream:
+    """
+    streaming response body run within the request profile: the queries and the time spent producing every chunk
+    are added to the request (`stream` phase), and on_close is called once when the stream is exhausted or closed
+    """
+
+    def __init__(self, content, profile, on_close):
+        self.iterator = iter(content)
+        self.profile = profile
+        self.on_close = on_close
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = perf_counter()
+        exhausted = False
+        try:
+            return self.profile.run(next, self.iterator)
+        except StopIteration:
+            exhausted = True
+            raise
+        finally:
+            self.profile.phases['stream'] = self.profile.phases.get('stream', 0.0) + perf_counter() - start
+            if exhausted:
+                self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if hasattr(self.iterator, 'close'):
+                self.iterator.close()
+        finally:
+            self.on_close()
+
+
+class InstrumentationMiddleware:
+    """
+    per request SQL and timing instrumentation. keep it first in MIDDLEWARE so it covers the whole request
+    """
+
+    def __init__(self, get_response):
+        if not settings.INSTRUMENTATION_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        profile = RequestProfile()
+        start = perf_counter()
+        response = profile.run(self.get_response, request)
+        end = perf_counter()
+        if profile.view_start is not None:
+            profile.phases['view'] = end - profile.view_start
+
+        if response.streaming and not response.is_async:
+            # the body (and its queries) is produced while the server iterates it: the request is recorded when the
+            # stream is closed, and no Server-Timing header is sent since the headers go out before the body
+            response.streaming_content = InstrumentedStream(
+                response.streaming_content, profile, lambda: self.record(request, response, profile, perf_counter() - start)
+            )
+            return response
+
+        phases = self.record(request, response, profile, end - start)
+        if settings.INSTRUMENTATION_SERVER_TIMING:
+            timings = [f'{phase};dur={seconds * 1000:.2f}' for phase, seconds in phases.items() if phase != 'db']
+            timings.append(f'db;dur={profile.db_time * 1000:.2f};desc="{profile.queries} queries"')
+            timings.append(f'total;dur={(end - start) * 1000:.2f}')
+            response['Server-Timing'] = ', '.join(timings)
+        return response
+
+    def record(self, request, response, profile, duration):
+        """
+        add the request to the histograms and write the slow request log line
+        rtype: dict, seconds per phase
+        """
+        route = profile.endpoint or 'unmatched'
+        phases = dict(profile.phases, db=profile.db_time)
+
+        histograms.observe(request.method, route, response.status_code, duration, profile.queries, phases)
+
+        if duration * 1000 >= settings.INSTRUMENTATION_SLOW_REQUEST_MS and sampled():
+            log_event(
+                'slow_request',
+                method=request.method,
+                path=request.path,
+                endpoint=route,
+                status=response.status_code,
+                duration_ms=round(duration * 1000, 3),
+                queries=profile.queries,
+                **{f'{phase}_ms': round(seconds * 1000, 3) for phase, seconds in phases.items()}
+            )
+        return phases
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        profile = _current.get()
+        if profile is not None:
+            profile.endpoint = '/' + request.resolver_match.route
+            profile.view_start = perf_counter()
+        return None
+
+
+# Prometheus metrics view
+# endpoint: GET /metrics/
+def metrics_view(request):
+    """
+    per endpoint histograms of this process in Prometheus text format.
+    closed by default: the scraper has to send INSTRUMENTATION_METRICS_TOKEN as a bearer token, or the request has
+    to come from a logged in staff user, unless INSTRUMENTATION_METRICS_PUBLIC opens it explicitly
+    """
+    if not settings.INSTRUMENTATION_ENABLED:
+        return HttpResponseNotFound()
+    token = settings.INSTRUMENTATION_METRICS_TOKEN
+    allowed = (
+        settings.INSTRUMENTATION_METRICS_PUBLIC
+        or (token and constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {token}'))
+        or getattr(request, 'user', None) is not None and request.user.is_staff
+    )
+    if not allowed:
+        return HttpResponseForbidden()
+    return HttpResponse(histograms.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -33,6 +33,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'vendorManagement.instrumentation.InstrumentationMiddleware',  # first, so it covers the whole request
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -48,7 +49,7 @@ ROOT_URLCONF = 'vendorManagement.urls'
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'vendorManagement.instrumentation.TimedJWTAuthentication',  # JWTAuthentication timed as the auth phase
     ),
 
     'DEFAULT_PERMISSION_CLASSES': [
@@ -61,6 +62,50 @@ SIMPLE_JWT = {
     'REFRESH_TOKEN_LIFETIME': timedelta(days=365),
 }
 
+# Bulk purchase order endpoints (/api/purchase_orders/bulk/)
+PURCHASE_ORDER_BULK_MAX_ITEMS = 10000   # maximum number of purchase orders in one bulk request
+PURCHASE_ORDER_BULK_BATCH_SIZE = 1000   # rows per INSERT/UPDATE statement
+
+# Streaming exports (/api/purchase_orders/export/, /api/vendors/export/)
+EXPORT_CHUNK_SIZE = 2000     # rows fetched from the database per round trip
+EXPORT_BUFFER_SIZE = 65536   # bytes of encoded rows sent per chunk
+EXPORT_WATERMARK_MARGIN = 300   # seconds the watermark is moved back, longer than the longest purchase order write transaction
+
+# SKU level queries (/api/items/{sku}/vendors/, /api/vendors/{vendor_id}/items/)
+LINE_ITEM_QUERY_MAX_LIMIT = 1000   # maximum `limit` of one response
+LINE_ITEM_QUERY_MAX_DAYS = 36500   # maximum `days` window (larger values cannot be subtracted from the current date)
+
+# Cache
+# local memory by default. point 'default' (or VENDOR_CACHE_ALIAS) to memcached/redis to share it between workers
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'OPTIONS': {'MAX_ENTRIES': 50000},
+    }
+}
+
+VENDOR_CACHE_ALIAS = 'default'   # cache used by the vendor details/performance read endpoints
+VENDOR_CACHE_TIMEOUT = 300       # seconds a cached vendor response is kept (entries are also invalidated on writes)
+
+# Vendor metrics
+# 'sync'  : purchase order writes update the vendor metrics counters inside the request
+# 'async' : purchase order writes only queue a "vendor dirty" marker, `python manage.py run_metrics_worker`
+#           recomputes the marked vendors out of band (requires a shared cache backend, see vendor/checks.py)
+VENDOR_METRICS_MODE = 'sync'
+VENDOR_METRICS_WORKER_BATCH_SIZE = 500   # vendors recomputed per batch by the worker
+VENDOR_METRICS_WORKER_PROCESSES = 1      # size of the worker process pool (1 runs the batches in the worker itself)
+
+# Request instrumentation (vendorManagement/instrumentation.py)
+# SQL query count/time and phase timings per request, Server-Timing header, slow request/query logs and
+# per endpoint Prometheus histograms at /metrics/
+INSTRUMENTATION_ENABLED = True
+INSTRUMENTATION_SERVER_TIMING = True      # add the Server-Timing header to every response
+INSTRUMENTATION_SLOW_REQUEST_MS = 1000    # log requests slower than this
+INSTRUMENTATION_SLOW_QUERY_MS = 200       # log SQL queries slower than this
+INSTRUMENTATION_LOG_SAMPLE_RATE = 1.0     # fraction of the slow requests/queries which are logged (0.0 - 1.0)
+INSTRUMENTATION_METRICS_TOKEN = None      # bearer token of the scraper for /metrics/ (without it only staff users can read it)
+INSTRUMENTATION_METRICS_PUBLIC = False    # True opens /metrics/ to everyone (only behind a proxy restricting it)
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',